@@ -3,19 +3,29 @@ WarrantyVault AI Microservice
 Production-grade OCR and structured extraction using PaddleOCR + Donut
 """
 
-from fastapi import FastAPI, File, UploadFile, HTTPException
+from fastapi import FastAPI, File, Request, UploadFile, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
-from paddleocr import PaddleOCR
 from transformers import DonutProcessor, VisionEncoderDecoderModel
+from transformers.modeling_outputs import BaseModelOutput
 from PIL import Image
-from pdf2image import convert_from_bytes
-import io
+import fitz  # PyMuPDF
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager, nullcontext
+import asyncio
+import hashlib
+import multiprocessing
 import os
+import threading
 import logging
+import numpy as np
 import torch
 import re
-from typing import Dict, Any, Optional
+import ocr_worker
+from ocr_worker import PADDLE_OCR_USE_ONNX, create_paddle_ocr, run_paddle_ocr, warmup_paddle_ocr
+from typing import Dict, Any, BinaryIO, Iterator, List, Optional, Tuple
 
 # ============================================================
 # CONFIGURATION
@@ -24,12 +34,77 @@ from typing import Dict, Any, Optional
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Load and warm up PaddleOCR (and the OCR worker processes if OCR_POOL_PRELOAD),
+    then start the Donut batcher. Donut (the fallback extractor) is preloaded
+    in the background so OCR is served without waiting for its warm-up
+    (cuDNN autotuning / torch.compile).
+    """
+    global donut_queue, donut_batcher_task, donut_preload_task
+    
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(executor, warmup_paddleocr)
+    if OCR_POOL_PRELOAD:
+        # Spawning the workers takes tens of seconds; pay it here, not on the first batch
+        try:
+            await loop.run_in_executor(executor, warmup_ocr_process_pool)
+        except Exception as e:
+            logger.error(f"OCR process pool warm-up failed, it will be started on first use: {e}")
+    
+    donut_queue = asyncio.Queue()
+    donut_batcher_task = asyncio.create_task(donut_batcher())
+    if DONUT_PRELOAD:
+        donut_preload_task = asyncio.create_task(preload_donut_in_background())
+    
+    yield
+    
+    if donut_preload_task is not None:
+        donut_preload_task.cancel()
+    donut_batcher_task.cancel()
+    executor.shutdown(wait=False)
+    donut_encoder_executor.shutdown(wait=False)
+    if ocr_process_pool is not None:
+        ocr_process_pool.shutdown(wait=False)
+
+
 app = FastAPI(
     title="WarrantyVault AI Service",
     description="OCR and structured extraction for invoices",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
+# Maximum number of files accepted by /extract-text-batch
+MAX_BATCH_FILES = int(os.environ.get("MAX_BATCH_FILES", 16))
+
+# Uploaded files larger than this are rejected with 413
+MAX_UPLOAD_BYTES = int(os.environ.get("MAX_UPLOAD_BYTES", 20 * 1024 * 1024))
+# Allowance for multipart boundaries and part headers on top of the file bytes
+MULTIPART_OVERHEAD_BYTES = 64 * 1024
+
+
+@app.middleware("http")
+async def limit_request_size(request: Request, call_next):
+    """
+    Reject oversized uploads from their Content-Length header, before the
+    body is read. Chunked requests have no length and are checked per file.
+    Registered before CORS so that 413 responses still get CORS headers.
+    """
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit():
+        max_files = MAX_BATCH_FILES if request.url.path == "/extract-text-batch" else 1
+        if int(content_length) > max_files * MAX_UPLOAD_BYTES + MULTIPART_OVERHEAD_BYTES:
+            return JSONResponse(
+                status_code=413,
+                content={"detail": f"Request too large (max {MAX_UPLOAD_BYTES // (1024 * 1024)} MB per file)"}
+            )
+    
+    return await call_next(request)
+
+
 # CORS configuration
 app.add_middleware(
     CORSMiddleware,
@@ -39,167 +114,780 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Initialize PaddleOCR (English)
-paddle_ocr = PaddleOCR(use_angle_cls=True, lang='en', show_log=False)
+# PDFs with more pages than this are rejected (each page is rasterized for OCR)
+MAX_PDF_PAGES = int(os.environ.get("MAX_PDF_PAGES", 20))
+
+# Resolution used to rasterize PDF pages (enough for both OCR and Donut)
+PDF_RENDER_DPI = int(os.environ.get("PDF_RENDER_DPI", 150))
+
+# Image bound handed to PaddleOCR/Donut, matching the docvqa processor input (1920x2560).
+# Larger photos are downscaled once, keeping orientation (long side <= MAX_IMAGE_LONG_SIDE)
+MAX_IMAGE_SHORT_SIDE = int(os.environ.get("MAX_IMAGE_SHORT_SIDE", 1920))
+MAX_IMAGE_LONG_SIDE = int(os.environ.get("MAX_IMAGE_LONG_SIDE", 2560))
+
+# Thread pool for blocking work (PDF rendering, OCR, Donut) so the event loop stays free
+MAX_WORKERS = int(os.environ.get("MAX_WORKERS", os.cpu_count() or 4))
+executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
 
-# Initialize Donut model for structured extraction (lazy load)
+# PaddleOCR of the service process (settings in ocr_worker.py), created by warmup_paddleocr()
+paddle_ocr = None
+# Paddle predictors are not thread-safe, so OCR calls are serialized
+paddle_ocr_lock = threading.Lock()
+
+# Worker processes (each with its own PaddleOCR) for multi-page PDFs and batches.
+# Started on first use, or at startup with OCR_POOL_PRELOAD=True
+OCR_PROCESS_WORKERS = int(os.environ.get("OCR_PROCESS_WORKERS", min(os.cpu_count() or 1, 4)))
+OCR_POOL_PRELOAD = os.environ.get("OCR_POOL_PRELOAD", "False").lower() == "true"
+# How long the startup warm-up waits for all workers to come up
+OCR_POOL_WARMUP_TIMEOUT = 300
+ocr_process_pool: Optional[ProcessPoolExecutor] = None
+ocr_process_pool_lock = threading.Lock()
+
+# Initialize Donut model for structured extraction (loaded at startup unless DONUT_PRELOAD=False)
+DONUT_PRELOAD = os.environ.get("DONUT_PRELOAD", "True").lower() == "true"
 donut_processor = None
 donut_model = None
+donut_warmed_up = False
+# Re-entrant: the compile warm-up runs inference while the model is loading
+donut_load_lock = threading.RLock()
+
+# Run Donut in bfloat16 autocast on CPU (FP16 weights are always used on GPU)
+DONUT_CPU_BF16 = os.environ.get("DONUT_CPU_BF16", "True").lower() == "true"
+
+# Compile the Donut encoder with torch.compile (GPU only, uses CUDA graphs).
+# CUDA graphs are recorded per thread, so the encoder always runs on one dedicated thread
+DONUT_COMPILE = os.environ.get("DONUT_COMPILE", "True").lower() == "true"
+donut_encoder_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="donut-encoder")
+# Original encoder while the compiled one is installed (fallback if it fails at call time)
+donut_eager_encoder = None
+
+# Encoder outputs keyed by image digest, so repeated documents skip the encoder
+DONUT_ENCODER_CACHE_SIZE = int(os.environ.get("DONUT_ENCODER_CACHE_SIZE", 8))
+donut_encoder_cache: "OrderedDict[str, BaseModelOutput]" = OrderedDict()
+donut_encoder_cache_lock = threading.Lock()
+
+# Dynamic batching of /ai-structured-extract requests (queue created in lifespan)
+DONUT_MAX_BATCH_SIZE = int(os.environ.get("DONUT_MAX_BATCH_SIZE", 8))
+# Encoder batch sizes compiled ahead of time (powers of two, capped at DONUT_MAX_BATCH_SIZE).
+# Smaller batches are padded up to the next one, so the compiled encoder never sees a new shape
+DONUT_ENCODER_BATCH_SIZES = sorted({min(2 ** i, DONUT_MAX_BATCH_SIZE) for i in range(DONUT_MAX_BATCH_SIZE.bit_length() + 1)})
+DONUT_BATCH_TIMEOUT_MS = float(os.environ.get("DONUT_BATCH_TIMEOUT_MS", 20))
+donut_queue: Optional[asyncio.Queue] = None
+donut_batcher_task: Optional[asyncio.Task] = None
+donut_preload_task: Optional[asyncio.Task] = None
 
 # ============================================================
 # HELPER FUNCTIONS
 # ============================================================
 
 def load_donut_model():
-    """Lazy load Donut model to save memory"""
+    """Load Donut model on first use (or at startup, see lifespan)"""
+    with donut_load_lock:
+        if donut_processor is None or donut_model is None:
+            _load_donut_model()
+    
+    return donut_processor, donut_model
+
+
+def _load_donut_model():
+    """Load the Donut processor and model into the module globals"""
     global donut_processor, donut_model
     
-    if donut_processor is None or donut_model is None:
-        logger.info("Loading Donut model...")
-        try:
-            donut_processor = DonutProcessor.from_pretrained("naver-clova-ix/donut-base-finetuned-docvqa")
-            donut_model = VisionEncoderDecoderModel.from_pretrained("naver-clova-ix/donut-base-finetuned-docvqa")
-            
-            # Use GPU if available
-            if torch.cuda.is_available():
-                donut_model.to("cuda")
-                logger.info("Donut model loaded on GPU")
-            else:
-                logger.info("Donut model loaded on CPU")
-        except Exception as e:
-            logger.error(f"Failed to load Donut model: {e}")
-            raise
+    logger.info("Loading Donut model...")
+    try:
+        donut_processor = DonutProcessor.from_pretrained("naver-clova-ix/donut-base-finetuned-docvqa")
+        donut_model = VisionEncoderDecoderModel.from_pretrained("naver-clova-ix/donut-base-finetuned-docvqa")
+        
+        donut_model.eval()
+        
+        # Decoding relies on the KV cache (prompt + cross-attention), never on recomputation
+        donut_model.config.decoder.use_cache = True
+        if donut_model.is_gradient_checkpointing:
+            donut_model.gradient_checkpointing_disable()
+        
+        # Use GPU if available (FP16 weights, TF32 matmuls for any FP32 ops left)
+        if torch.cuda.is_available():
+            torch.backends.cudnn.benchmark = True
+            torch.backends.cuda.matmul.allow_tf32 = True
+            torch.backends.cudnn.allow_tf32 = True
+            donut_model.to("cuda")
+            donut_model.half()
+            logger.info("Donut model loaded on GPU (fp16)")
+        else:
+            logger.info(f"Donut model loaded on CPU ({'bf16 autocast' if DONUT_CPU_BF16 else 'fp32'})")
+        
+        if torch.cuda.is_available() and DONUT_COMPILE:
+            compile_donut_encoder()
+    except Exception as e:
+        logger.error(f"Failed to load Donut model: {e}")
+        # Leave nothing half-loaded so the next request retries
+        donut_processor = None
+        donut_model = None
+        raise
+
+
+def compile_donut_encoder():
+    """
+    Compile the Donut encoder with static shapes and warm it up at each of
+    DONUT_ENCODER_BATCH_SIZES (batches are padded to these), so no request pays
+    for compilation or CUDA-graph recording.
+    Falls back to the eager encoder if compilation fails (see run_donut_encoder).
+    """
+    global donut_eager_encoder
+    import torch._dynamo
     
-    return donut_processor, donut_model
+    logger.info("Compiling Donut encoder...")
+    # One compiled graph per batch size: keep dynamo from falling back to eager
+    torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, len(DONUT_ENCODER_BATCH_SIZES))
+    try:
+        compiled_encoder = torch.compile(donut_model.encoder, mode="reduce-overhead", fullgraph=True, dynamic=False)
+    except Exception as e:
+        logger.warning(f"torch.compile failed, using eager Donut encoder: {e}")
+        return
+    
+    donut_eager_encoder = donut_model.encoder
+    donut_model.encoder = compiled_encoder
+    
+    dummy_image = Image.new("RGB", (1920, 2560), "white")
+    for batch_size in DONUT_ENCODER_BATCH_SIZES:
+        run_donut_encoder([dummy_image] * batch_size)
+        if donut_eager_encoder is None:
+            return
+    
+    warmup_donut_model()
+    logger.info(f"Donut encoder compiled for batch sizes {DONUT_ENCODER_BATCH_SIZES}")
+
+
+def warmup_donut_model():
+    """Load Donut and run one dummy document through it (bypasses the encoder cache)"""
+    global donut_warmed_up
+    
+    load_donut_model()
+    
+    dummy_image = Image.new("RGB", (1920, 2560), "white")
+    hidden_state = run_donut_encoder([dummy_image])
+    decode_prompts(BaseModelOutput(last_hidden_state=hidden_state), [DONUT_PROMPTS["total_amount"]])
+    donut_warmed_up = True
+    logger.info("Donut model warmed up")
+
+
+def preload_donut_model():
+    """Load Donut at startup and warm it up, unless loading already did (compile warm-up)"""
+    load_donut_model()
+    if not donut_warmed_up:
+        warmup_donut_model()
+
+
+async def preload_donut_in_background():
+    """
+    Preload Donut after startup. Requests that need it meanwhile wait for the
+    load; a failure is only logged (Donut is loaded again on first use) so it
+    never takes OCR down.
+    """
+    try:
+        await asyncio.get_running_loop().run_in_executor(executor, preload_donut_model)
+    except Exception as e:
+        logger.error(f"Donut preload failed, it will be loaded on first use: {e}")
+
+
+def get_paddle_ocr():
+    """This process's PaddleOCR, created on first use (call with paddle_ocr_lock held)"""
+    global paddle_ocr
+    
+    if paddle_ocr is None:
+        paddle_ocr = create_paddle_ocr()
+    return paddle_ocr
+
+
+def warmup_paddleocr():
+    """Create PaddleOCR and run it once so predictors are initialized before the first request"""
+    with paddle_ocr_lock:
+        warmup_paddle_ocr(get_paddle_ocr())
+    logger.info("PaddleOCR warmed up")
+
+
+def render_pdf_page(page: "fitz.Page") -> Image.Image:
+    """Rasterize a single PDF page to an RGB PIL Image"""
+    pix = page.get_pixmap(dpi=PDF_RENDER_DPI, alpha=False)
+    return Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
 
 
 def convert_pdf_to_image(pdf_bytes: bytes) -> Image.Image:
-    """Convert PDF to PIL Image (first page only)"""
+    """Convert PDF to PIL Image (first page only), rendered in-process with PyMuPDF"""
     try:
-        images = convert_from_bytes(pdf_bytes, dpi=300, first_page=1, last_page=1)
-        return images[0] if images else None
+        with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
+            if doc.page_count == 0:
+                return None
+            return render_pdf_page(doc[0])
     except Exception as e:
         logger.error(f"PDF conversion failed: {e}")
         raise
 
 
-def extract_text_with_paddleocr(image: Image.Image) -> Dict[str, Any]:
+def get_image_bound(size: Tuple[int, int]) -> Tuple[int, int]:
+    """(width, height) bound for an image of the given size, following its orientation"""
+    width, height = size
+    if height >= width:
+        return MAX_IMAGE_SHORT_SIDE, MAX_IMAGE_LONG_SIDE
+    return MAX_IMAGE_LONG_SIDE, MAX_IMAGE_SHORT_SIDE
+
+
+def preprocess_image(image: Image.Image) -> Image.Image:
+    """
+    Convert to RGB and downscale to fit Donut's native input size
+    (MAX_IMAGE_SHORT_SIDE x MAX_IMAGE_LONG_SIDE, in the image's orientation).
+    Done once here so neither the Donut processor nor PaddleOCR detection
+    has to work on full-size camera photos.
+    """
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    image.thumbnail(get_image_bound(image.size), Image.LANCZOS)
+    return image
+
+
+def get_upload_file(file: UploadFile) -> BinaryIO:
     """
-    Extract text from image using PaddleOCR
-    Returns: {text, confidence}
+    Return the upload's underlying file, which Starlette has already spooled
+    (in memory, or on disk for large files). Raises 413 above MAX_UPLOAD_BYTES.
     """
+    if file.size is not None and file.size > MAX_UPLOAD_BYTES:
+        raise HTTPException(
+            status_code=413,
+            detail=f"File too large (max {MAX_UPLOAD_BYTES // (1024 * 1024)} MB)"
+        )
+    
+    file.file.seek(0)
+    return file.file
+
+
+def load_file_image(file_obj: BinaryIO, content_type: Optional[str]) -> Optional[Image.Image]:
+    """Decode an uploaded PDF/JPG/PNG into a preprocessed PIL Image"""
+    if content_type == "application/pdf":
+        logger.info("Converting PDF to image...")
+        image = convert_pdf_to_image(file_obj.read())
+    else:
+        # Assume image format (JPG/PNG), decoded straight from the buffer
+        image = Image.open(file_obj)
+        # Let the JPEG decoder downscale by a power of two while decoding
+        image.draft("RGB", get_image_bound(image.size))
+        # Decode now, the upload file is closed once the request finishes
+        image.load()
+    
+    return preprocess_image(image) if image is not None else None
+
+
+def load_document(file_obj: BinaryIO, content_type: Optional[str]) -> Optional[Dict[str, Any]]:
+    """
+    Prepare an uploaded PDF/JPG/PNG for OCR without rasterizing it yet.
+    Returns {"pdf": bytes, "page_count": n} or {"image": Image, "page_count": 1}.
+    Raises 413 for PDFs with more than MAX_PDF_PAGES pages.
+    """
+    if content_type != "application/pdf":
+        image = load_file_image(file_obj, content_type)
+        return {"image": image, "page_count": 1} if image is not None else None
+    
+    pdf_bytes = file_obj.read()
     try:
-        # Convert PIL Image to format PaddleOCR expects
-        img_array = image
-        
-        # Run OCR
-        result = paddle_ocr.ocr(img_array, cls=True)
-        
-        if not result or not result[0]:
-            return {"text": "", "confidence": 0.0}
-        
-        # Extract text and confidence scores
-        extracted_lines = []
-        confidence_scores = []
-        
-        for line in result[0]:
-            text = line[1][0]  # Text content
-            confidence = line[1][1]  # Confidence score
-            extracted_lines.append(text)
-            confidence_scores.append(confidence)
-        
-        full_text = "\n".join(extracted_lines)
-        avg_confidence = sum(confidence_scores) / len(confidence_scores) if confidence_scores else 0.0
+        with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
+            page_count = doc.page_count
+    except Exception as e:
+        logger.error(f"PDF conversion failed: {e}")
+        raise
+    
+    if page_count == 0:
+        return None
+    if page_count > MAX_PDF_PAGES:
+        raise HTTPException(status_code=413, detail=f"PDF has too many pages (max {MAX_PDF_PAGES})")
+    
+    return {"pdf": pdf_bytes, "page_count": page_count}
+
+
+def iter_document_pages(document: Dict[str, Any]) -> Iterator[Image.Image]:
+    """Yield the preprocessed page images of a document, rendering PDF pages one at a time"""
+    if "image" in document:
+        yield document["image"]
+        return
+    
+    with fitz.open(stream=document["pdf"], filetype="pdf") as doc:
+        for page in doc:
+            yield preprocess_image(render_pdf_page(page))
+
+
+def reset_ocr_process_pool(broken_pool: ProcessPoolExecutor):
+    """Drop a broken OCR process pool so the next call starts a fresh one"""
+    global ocr_process_pool
+    
+    with ocr_process_pool_lock:
+        if ocr_process_pool is broken_pool:
+            ocr_process_pool = None
+    broken_pool.shutdown(wait=False)
+
+
+def get_ocr_process_pool() -> ProcessPoolExecutor:
+    """Process pool for multi-page OCR, created on first use (and again after a crash)"""
+    global ocr_process_pool
+    
+    with ocr_process_pool_lock:
+        if ocr_process_pool is None:
+            logger.info(f"Starting OCR process pool ({OCR_PROCESS_WORKERS} workers)...")
+            ocr_process_pool = ProcessPoolExecutor(
+                max_workers=OCR_PROCESS_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=ocr_worker.init_ocr_worker
+            )
+    
+    return ocr_process_pool
+
+
+def to_paddle_array(image: Image.Image) -> np.ndarray:
+    """Convert PIL Image to the BGR uint8 array PaddleOCR expects (cv2 layout)"""
+    return np.ascontiguousarray(np.asarray(image.convert("RGB"))[:, :, ::-1])
+
+
+def warmup_ocr_process_pool():
+    """
+    Start the OCR process pool and wait until every worker is up.
+    One task per worker, each waiting on a shared barrier, so no worker can
+    take two of them: all OCR_PROCESS_WORKERS workers are spawned and have run
+    ocr_worker.init_ocr_worker() (their PaddleOCR warm-up) when this returns.
+    """
+    pool = get_ocr_process_pool()
+    with multiprocessing.get_context("spawn").Manager() as manager:
+        barrier = manager.Barrier(OCR_PROCESS_WORKERS)
+        futures = [
+            pool.submit(ocr_worker.wait_for_workers, barrier, OCR_POOL_WARMUP_TIMEOUT)
+            for _ in range(OCR_PROCESS_WORKERS)
+        ]
+        try:
+            worker_pids = {future.result() for future in futures}
+        except BrokenProcessPool:
+            reset_ocr_process_pool(pool)
+            raise
+    logger.info(f"OCR process pool warmed up ({len(worker_pids)} workers)")
+
+
+def summarize_ocr_lines(ocr_lines: List) -> Dict[str, Any]:
+    """Join PaddleOCR lines into {text, confidence}"""
+    if not ocr_lines:
+        return {"text": "", "confidence": 0.0}
+    
+    # Extract text and confidence scores (line = [box, (text, confidence)])
+    extracted_lines = [line[1][0] for line in ocr_lines]
+    confidence_scores = np.fromiter((line[1][1] for line in ocr_lines), dtype=np.float32, count=len(ocr_lines))
+    
+    full_text = "\n".join(extracted_lines)
+    avg_confidence = float(confidence_scores.mean()) if confidence_scores.size else 0.0
+    
+    logger.info(f"Extracted {len(extracted_lines)} lines with avg confidence: {avg_confidence:.2f}")
+    
+    return {
+        "text": full_text,
+        "confidence": round(avg_confidence, 4)
+    }
+
+
+def ocr_page_in_process(image: Image.Image, rotate: bool) -> List:
+    """OCR one page with this process's PaddleOCR instance; returns PaddleOCR lines"""
+    img_array = to_paddle_array(image)
+    with paddle_ocr_lock:
+        return run_paddle_ocr(get_paddle_ocr(), img_array, rotate)
+
+
+def ocr_pages_in_pool(pool: ProcessPoolExecutor, pages: Iterator[Image.Image], rotate: bool) -> List[List]:
+    """
+    OCR pages on the process pool, in page order. At most two pages per worker
+    are in flight, so pages are rendered and converted only as workers free up.
+    """
+    page_lines = []
+    pending = deque()
+    
+    for page in pages:
+        pending.append(pool.submit(ocr_worker.ocr_page_worker, to_paddle_array(page), rotate))
+        if len(pending) >= OCR_PROCESS_WORKERS * 2:
+            page_lines.append(pending.popleft().result())
+    
+    page_lines.extend(future.result() for future in pending)
+    return page_lines
+
+
+def extract_text_from_documents(documents: List[Dict[str, Any]], rotate: bool = False) -> List[Dict[str, Any]]:
+    """
+    Extract text from several documents (see load_document).
+    A single page is OCR'd in-process; otherwise every page of every document
+    is spread over the OCR process pool and joined back per document in page order.
+    Falls back to in-process OCR if the pool breaks (e.g. a worker crashed).
+    """
+    page_counts = [document["page_count"] for document in documents]
+    
+    def all_pages() -> Iterator[Image.Image]:
+        for document in documents:
+            yield from iter_document_pages(document)
+    
+    try:
+        if sum(page_counts) == 1:
+            page_lines = [ocr_page_in_process(page, rotate) for page in all_pages()]
+        else:
+            logger.info(f"Running OCR on {sum(page_counts)} pages in parallel...")
+            pool = get_ocr_process_pool()
+            try:
+                page_lines = ocr_pages_in_pool(pool, all_pages(), rotate)
+            except BrokenProcessPool as e:
+                logger.warning(f"OCR process pool broke, falling back to in-process OCR: {e}")
+                reset_ocr_process_pool(pool)
+                page_lines = [ocr_page_in_process(page, rotate) for page in all_pages()]
         
-        logger.info(f"Extracted {len(extracted_lines)} lines with avg confidence: {avg_confidence:.2f}")
+        results = []
+        offset = 0
+        for page_count in page_counts:
+            document_lines = page_lines[offset:offset + page_count]
+            results.append(summarize_ocr_lines([line for lines in document_lines for line in lines]))
+            offset += page_count
         
-        return {
-            "text": full_text,
-            "confidence": round(avg_confidence, 4)
-        }
+        return results
     
     except Exception as e:
         logger.error(f"PaddleOCR extraction failed: {e}")
         raise
 
 
-def extract_structured_with_donut(image: Image.Image, target_field: str) -> str:
+def extract_text_from_document(document: Dict[str, Any], rotate: bool = False) -> Dict[str, Any]:
+    """Extract text from every page of a single document"""
+    return extract_text_from_documents([document], rotate)[0]
+
+
+# Prompt used for each structured field (DocVQA-style questions)
+DONUT_PROMPTS = {
+    "product_name": "What is the product name?",
+    "order_id": "What is the order ID?",
+    "invoice_number": "What is the invoice number?",
+    "total_amount": "What is the total amount?",
+    "purchase_date": "What is the purchase date?",
+    "retailer": "What is the retailer name?"
+}
+
+# Answer length cap per field in generated tokens (including closing tags and eos).
+# product_name leaves room for long marketplace titles
+DONUT_MAX_NEW_TOKENS = {
+    "product_name": 64,
+    "order_id": 24,
+    "invoice_number": 24,
+    "total_amount": 12,
+    "purchase_date": 16,
+    "retailer": 16
+}
+DONUT_DEFAULT_MAX_NEW_TOKENS = 32
+
+# Fields where a cut-off value is wrong rather than incomplete: an answer that
+# does not finish within its cap is returned as "" instead of truncated
+DONUT_EXACT_FIELDS = {"order_id", "invoice_number", "total_amount", "purchase_date"}
+
+
+# Matches every tag left in a decoded answer: </s_answer>, </s> (eos) and <pad>
+DONUT_TAG_RE = re.compile(r"<.*?>")
+
+
+def get_donut_device() -> str:
+    """Device the Donut model runs on"""
+    return "cuda" if torch.cuda.is_available() else "cpu"
+
+
+def donut_autocast():
+    """Autocast context for Donut inference (bf16 on CPU, no-op on GPU)"""
+    if not torch.cuda.is_available() and DONUT_CPU_BF16:
+        return torch.autocast("cpu", dtype=torch.bfloat16)
+    return nullcontext()
+
+
+def get_image_digest(image: Image.Image) -> str:
+    """Content hash of an image, used as the encoder cache key"""
+    digest = hashlib.sha1(image.tobytes())
+    digest.update(f"{image.mode}:{image.size}".encode())
+    return digest.hexdigest()
+
+
+def run_donut_encoder(images: List[Image.Image]) -> torch.Tensor:
     """
-    Extract specific field using Donut model
+    Preprocess images and run the Donut encoder on them (uncached), in batches
+    of at most DONUT_MAX_BATCH_SIZE. Returns the encoder hidden states, one row per image.
     """
-    try:
-        processor, model = load_donut_model()
-        
-        # Prepare prompt for field extraction
-        prompt_map = {
-            "product_name": "What is the product name?",
-            "order_id": "What is the order ID?",
-            "invoice_number": "What is the invoice number?",
-            "total_amount": "What is the total amount?",
-            "purchase_date": "What is the purchase date?",
-            "retailer": "What is the retailer name?"
-        }
-        
-        prompt = prompt_map.get(target_field, f"What is the {target_field}?")
-        
-        # Prepare input
-        pixel_values = processor(image, return_tensors="pt").pixel_values
-        
-        if torch.cuda.is_available():
-            pixel_values = pixel_values.to("cuda")
-        
-        # Generate answer
-        decoder_input_ids = processor.tokenizer(
-            f"<s_docvqa><s_question>{prompt}</s_question><s_answer>",
-            add_special_tokens=False,
-            return_tensors="pt"
-        ).input_ids
+    if len(images) > DONUT_MAX_BATCH_SIZE:
+        return torch.cat([
+            run_donut_encoder(images[start:start + DONUT_MAX_BATCH_SIZE])
+            for start in range(0, len(images), DONUT_MAX_BATCH_SIZE)
+        ])
+    
+    processor, model = load_donut_model()
+    
+    pixel_values = processor(images, return_tensors="pt").pixel_values
+    pixel_values = pixel_values.to(get_donut_device(), dtype=model.dtype)
+    
+    return donut_encoder_executor.submit(_run_donut_encoder, model, pixel_values).result()
+
+
+def get_encoder_batch_size(batch_size: int) -> int:
+    """Smallest of DONUT_ENCODER_BATCH_SIZES that fits batch_size"""
+    for encoder_batch_size in DONUT_ENCODER_BATCH_SIZES:
+        if encoder_batch_size >= batch_size:
+            return encoder_batch_size
+    return batch_size
+
+
+def _run_donut_encoder(model: VisionEncoderDecoderModel, pixel_values: torch.Tensor) -> torch.Tensor:
+    """Encoder forward pass; runs on the dedicated encoder thread"""
+    global donut_eager_encoder
+    
+    batch_size = pixel_values.shape[0]
+    # The compiled encoder only has graphs for DONUT_ENCODER_BATCH_SIZES: pad with blank rows
+    if donut_eager_encoder is not None:
+        padding = get_encoder_batch_size(batch_size) - batch_size
+        if padding:
+            pixel_values = torch.cat([pixel_values, pixel_values.new_zeros(padding, *pixel_values.shape[1:])])
+    
+    with torch.inference_mode(), donut_autocast():
+        try:
+            encoder_outputs = model.encoder(pixel_values=pixel_values)
+        except Exception as e:
+            if donut_eager_encoder is None:
+                raise
+            logger.warning(f"Compiled Donut encoder failed, switching to eager encoder: {e}")
+            model.encoder = donut_eager_encoder
+            donut_eager_encoder = None
+            encoder_outputs = model.encoder(pixel_values=pixel_values)
         
-        if torch.cuda.is_available():
-            decoder_input_ids = decoder_input_ids.to("cuda")
+        # Clone: CUDA-graph (compiled) outputs are overwritten by the next replay
+        return encoder_outputs.last_hidden_state[:batch_size].clone()
+
+
+def encode_images(images: List[Image.Image]) -> List[BaseModelOutput]:
+    """
+    Run the Donut (Swin) encoder once per image, batching all cache misses.
+    Each result can be reused for any number of prompts and is cached
+    per image content (LRU, DONUT_ENCODER_CACHE_SIZE entries).
+    """
+    cache_keys = [get_image_digest(image) for image in images]
+    results: List[Optional[BaseModelOutput]] = [None] * len(images)
+    
+    with donut_encoder_cache_lock:
+        for index, cache_key in enumerate(cache_keys):
+            cached = donut_encoder_cache.get(cache_key)
+            if cached is not None:
+                donut_encoder_cache.move_to_end(cache_key)
+                logger.info("Donut encoder cache hit")
+                results[index] = cached
+    
+    missing = [index for index, result in enumerate(results) if result is None]
+    if missing:
+        hidden_states = run_donut_encoder([images[index] for index in missing])
         
-        outputs = model.generate(
-            pixel_values,
-            decoder_input_ids=decoder_input_ids,
-            max_length=model.decoder.config.max_position_embeddings,
-            early_stopping=True,
-            pad_token_id=processor.tokenizer.pad_token_id,
-            eos_token_id=processor.tokenizer.eos_token_id,
-            use_cache=True,
-            num_beams=1,
-            bad_words_ids=[[processor.tokenizer.unk_token_id]],
-            return_dict_in_generate=True,
-        )
+        with donut_encoder_cache_lock:
+            for row, index in enumerate(missing):
+                # Clone: a slice would keep the whole batch tensor alive in the cache
+                encoder_outputs = BaseModelOutput(last_hidden_state=hidden_states[row:row + 1].clone())
+                results[index] = encoder_outputs
+                
+                if DONUT_ENCODER_CACHE_SIZE > 0:
+                    donut_encoder_cache[cache_keys[index]] = encoder_outputs
+            
+            while len(donut_encoder_cache) > DONUT_ENCODER_CACHE_SIZE:
+                donut_encoder_cache.popitem(last=False)
+    
+    return results
+
+
+def project_cross_attention(model: VisionEncoderDecoderModel, hidden_state: torch.Tensor) -> List:
+    """
+    Project encoder states to cross-attention keys/values once per image.
+    Returns one (key, value) pair per decoder layer, one row per image.
+    """
+    if getattr(model, "enc_to_dec_proj", None) is not None:
+        hidden_state = model.enc_to_dec_proj(hidden_state)
+    
+    batch_size = hidden_state.shape[0]
+    cross_attention_states = []
+    for layer in model.decoder.get_decoder().layers:
+        attention = layer.encoder_attn
+        key_states = attention._shape(attention.k_proj(hidden_state), -1, batch_size)
+        value_states = attention._shape(attention.v_proj(hidden_state), -1, batch_size)
+        cross_attention_states.append((key_states, value_states))
+    
+    return cross_attention_states
+
+
+def build_cross_attention_cache(model: VisionEncoderDecoderModel, cross_attention_states: List, image_index: torch.Tensor) -> tuple:
+    """
+    Gather the projected cross-attention keys/values for each prompt row
+    (image_index[row] = image of that row). Returned as past_key_values with
+    empty self-attention entries, so generate() starts from the full prompt but
+    the decoder never re-projects the (identical) encoder states per prompt.
+    """
+    past_key_values = []
+    for layer, (key_states, value_states) in zip(model.decoder.get_decoder().layers, cross_attention_states):
+        attention = layer.encoder_attn
+        key_states = key_states.index_select(0, image_index)
+        value_states = value_states.index_select(0, image_index)
         
-        # Decode answer
-        sequence = processor.batch_decode(outputs.sequences)[0]
-        sequence = sequence.replace(processor.tokenizer.eos_token, "").replace(processor.tokenizer.pad_token, "")
-        sequence = re.sub(r"<.*?>", "", sequence, count=1).strip()  # Remove <s_answer> tag
+        empty_states = key_states.new_zeros(key_states.shape[0], attention.num_heads, 0, attention.head_dim)
+        past_key_values.append((empty_states, empty_states, key_states, value_states))
+    
+    return tuple(past_key_values)
+
+
+def decode_prompts(
+    encoder_outputs: BaseModelOutput,
+    prompts: List[str],
+    max_new_tokens: Optional[List[int]] = None,
+    discard_truncated: Optional[List[bool]] = None
+) -> List[str]:
+    """
+    Answer several questions with batched generate() calls.
+    encoder_outputs comes from encode_images() (one row per image); prompts are
+    grouped per image, len(prompts) // images consecutive prompts each.
+    max_new_tokens caps each answer (default DONUT_DEFAULT_MAX_NEW_TOKENS).
+    An answer that hits its cap without eos is truncated, or comes back as ""
+    where discard_truncated is set for its row.
+    
+    Prompts are batched only with prompts of the same token length: Donut's
+    decoder has no padding-aware positions, so padded rows would be decoded at
+    positions the model never saw. Every group shares the encoder states and
+    their cross-attention projection.
+    """
+    processor, model = load_donut_model()
+    device = get_donut_device()
+    
+    if max_new_tokens is None:
+        max_new_tokens = [DONUT_DEFAULT_MAX_NEW_TOKENS] * len(prompts)
+    if discard_truncated is None:
+        discard_truncated = [False] * len(prompts)
+    
+    prompt_ids = processor.tokenizer(
+        [f"<s_docvqa><s_question>{prompt}</s_question><s_answer>" for prompt in prompts],
+        add_special_tokens=False
+    ).input_ids
+    
+    rows_by_length: Dict[int, List[int]] = {}
+    for row, ids in enumerate(prompt_ids):
+        rows_by_length.setdefault(len(ids), []).append(row)
+    
+    hidden_state = encoder_outputs.last_hidden_state
+    prompts_per_image = len(prompts) // hidden_state.shape[0]
+    answers = [""] * len(prompts)
+    
+    with torch.inference_mode(), donut_autocast():
+        cross_attention_states = project_cross_attention(model, hidden_state)
         
-        return sequence
+        for prompt_length, rows in rows_by_length.items():
+            decoder_input_ids = torch.tensor([prompt_ids[row] for row in rows], device=device)
+            image_index = torch.tensor([row // prompts_per_image for row in rows], device=device)
+            
+            # Broadcast a single encoded image over all rows (view, no copy)
+            if hidden_state.shape[0] == 1:
+                group_hidden_state = hidden_state.expand(len(rows), *hidden_state.shape[1:])
+            else:
+                group_hidden_state = hidden_state.index_select(0, image_index)
+            
+            group_max_new_tokens = [max_new_tokens[row] for row in rows]
+            outputs = model.generate(
+                encoder_outputs=BaseModelOutput(last_hidden_state=group_hidden_state),
+                past_key_values=build_cross_attention_cache(model, cross_attention_states, image_index),
+                decoder_input_ids=decoder_input_ids,
+                max_new_tokens=max(group_max_new_tokens),
+                early_stopping=True,
+                pad_token_id=processor.tokenizer.pad_token_id,
+                eos_token_id=processor.tokenizer.eos_token_id,
+                use_cache=True,
+                num_beams=1,
+                bad_words_ids=[[processor.tokenizer.unk_token_id]],
+                return_dict_in_generate=True,
+            )
+            
+            # Decode only the generated answer tokens (drop the prompt)
+            answer_ids = outputs.sequences[:, prompt_length:]
+            eos_token_id = processor.tokenizer.eos_token_id
+            for row, row_ids, limit in zip(rows, answer_ids, group_max_new_tokens):
+                # No eos within the field's cap means the answer was cut off
+                if discard_truncated[row] and not (row_ids[:limit] == eos_token_id).any():
+                    logger.warning(f"Donut answer exceeded {limit} tokens, discarding it")
+                    continue
+                sequence = processor.tokenizer.decode(row_ids[:limit])
+                answers[row] = DONUT_TAG_RE.sub("", sequence).strip()
     
-    except Exception as e:
-        logger.error(f"Donut extraction failed for {target_field}: {e}")
-        return ""
+    return answers
 
 
-def extract_all_structured_fields(image: Image.Image) -> Dict[str, str]:
+def extract_structured_fields_batch(images: List[Image.Image]) -> List[Dict[str, str]]:
     """
-    Extract all required fields using Donut model
+    Extract all required fields for several documents using Donut model.
+    Images are encoded together and the (image, field) prompts are decoded
+    in batched generate() calls (see decode_prompts).
     """
     fields = ["product_name", "order_id", "invoice_number", "total_amount", "purchase_date", "retailer"]
-    results = {}
     
-    for field in fields:
-        try:
-            value = extract_structured_with_donut(image, field)
+    try:
+        encoded = encode_images(images)
+        hidden_state = torch.cat([encoder_outputs.last_hidden_state for encoder_outputs in encoded])
+        prompts = [DONUT_PROMPTS[field] for field in fields] * len(images)
+        max_new_tokens = [DONUT_MAX_NEW_TOKENS[field] for field in fields] * len(images)
+        discard_truncated = [field in DONUT_EXACT_FIELDS for field in fields] * len(images)
+        answers = decode_prompts(
+            BaseModelOutput(last_hidden_state=hidden_state), prompts, max_new_tokens, discard_truncated
+        )
+    except Exception as e:
+        logger.error(f"Donut extraction failed: {e}")
+        answers = [""] * (len(fields) * len(images))
+    
+    batch_results = []
+    for offset in range(0, len(answers), len(fields)):
+        results = {}
+        for field, value in zip(fields, answers[offset:offset + len(fields)]):
             results[field] = value if value else ""
             logger.info(f"Donut extracted {field}: {value}")
-        except Exception as e:
-            logger.error(f"Failed to extract {field}: {e}")
-            results[field] = ""
+        batch_results.append(results)
     
-    return results
+    return batch_results
+
+
+async def donut_batcher():
+    """
+    Background task that groups pending /ai-structured-extract requests.
+    Waits up to DONUT_BATCH_TIMEOUT_MS for more requests after the first one
+    (max DONUT_MAX_BATCH_SIZE) and runs them as a single Donut batch.
+    """
+    loop = asyncio.get_running_loop()
+    
+    while True:
+        batch = [await donut_queue.get()]
+        deadline = loop.time() + DONUT_BATCH_TIMEOUT_MS / 1000
+        
+        while len(batch) < DONUT_MAX_BATCH_SIZE:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(donut_queue.get(), timeout=remaining))
+            except asyncio.TimeoutError:
+                break
+        
+        images = [image for image, _ in batch]
+        logger.info(f"Running Donut batch of {len(images)} document(s)")
+        
+        try:
+            batch_results = await loop.run_in_executor(executor, extract_structured_fields_batch, images)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            continue
+        
+        for (_, future), results in zip(batch, batch_results):
+            if not future.done():
+                future.set_result(results)
+
+
+async def submit_structured_extract(image: Image.Image) -> Dict[str, str]:
+    """Queue an image for the Donut batcher and wait for its fields"""
+    future = asyncio.get_running_loop().create_future()
+    await donut_queue.put((image, future))
+    return await future
 
 
 # ============================================================
@@ -214,16 +902,17 @@ async def root():
         "service": "WarrantyVault AI Microservice",
         "version": "1.0.0",
         "models": {
-            "ocr": "PaddleOCR",
+            "ocr": "PaddleOCR (ONNX Runtime)" if PADDLE_OCR_USE_ONNX else "PaddleOCR",
             "structured": "Donut (naver-clova-ix/donut-base-finetuned-docvqa)"
         }
     }
 
 
 @app.post("/extract-text")
-async def extract_text(file: UploadFile = File(...)):
+async def extract_text(file: UploadFile = File(...), rotate: bool = False):
     """
-    Extract full text from uploaded invoice (PDF/JPG/PNG)
+    Extract full text from uploaded invoice (PDF/JPG/PNG, all PDF pages)
+    Pass ?rotate=true to classify and fix upside-down text lines.
     
     Returns:
     {
@@ -234,30 +923,78 @@ async def extract_text(file: UploadFile = File(...)):
     try:
         logger.info(f"Received file: {file.filename} ({file.content_type})")
         
-        # Read file bytes
-        file_bytes = await file.read()
+        loop = asyncio.get_running_loop()
         
-        # Determine file type and convert to image
-        if file.content_type == "application/pdf":
-            logger.info("Converting PDF to image...")
-            image = convert_pdf_to_image(file_bytes)
-        else:
-            # Assume image format (JPG/PNG)
-            image = Image.open(io.BytesIO(file_bytes))
+        file_obj = get_upload_file(file)
         
-        if image is None:
+        # Determine file type and prepare pages (off the event loop)
+        document = await loop.run_in_executor(executor, load_document, file_obj, file.content_type)
+        
+        if document is None:
             raise HTTPException(status_code=400, detail="Failed to process file")
         
         # Run OCR
-        result = extract_text_with_paddleocr(image)
+        result = await loop.run_in_executor(executor, extract_text_from_document, document, rotate)
         
         return JSONResponse(content=result)
     
+    except HTTPException:
+        raise
+    
     except Exception as e:
         logger.error(f"Error in /extract-text: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.post("/extract-text-batch")
+async def extract_text_batch(files: List[UploadFile] = File(...), rotate: bool = False):
+    """
+    Extract full text from several uploaded invoices (PDF/JPG/PNG) in one request.
+    All pages of all files are OCR'd in parallel.
+    
+    Returns:
+    {
+        "results": [
+            {"filename": "...", "text": "full extracted text", "confidence": average_confidence_score},
+            ...
+        ]
+    }
+    """
+    try:
+        logger.info(f"Received batch of {len(files)} files")
+        
+        if len(files) > MAX_BATCH_FILES:
+            raise HTTPException(status_code=400, detail=f"Too many files (max {MAX_BATCH_FILES})")
+        
+        loop = asyncio.get_running_loop()
+        
+        documents = []
+        for file in files:
+            file_obj = get_upload_file(file)
+            document = await loop.run_in_executor(executor, load_document, file_obj, file.content_type)
+            
+            if document is None:
+                raise HTTPException(status_code=400, detail=f"Failed to process file: {file.filename}")
+            documents.append(document)
+        
+        # Run OCR
+        results = await loop.run_in_executor(executor, extract_text_from_documents, documents, rotate)
+        
+        return JSONResponse(content={
+            "results": [
+                {"filename": file.filename, **result}
+                for file, result in zip(files, results)
+            ]
+        })
+    
+    except HTTPException:
+        raise
+    
+    except Exception as e:
+        logger.error(f"Error in /extract-text-batch: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
 @app.post("/ai-structured-extract")
 async def ai_structured_extract(file: UploadFile = File(...)):
     """
@@ -277,23 +1014,24 @@ async def ai_structured_extract(file: UploadFile = File(...)):
     try:
         logger.info(f"AI structured extraction for: {file.filename}")
         
-        # Read file bytes
-        file_bytes = await file.read()
+        loop = asyncio.get_running_loop()
         
-        # Convert to image
-        if file.content_type == "application/pdf":
-            image = convert_pdf_to_image(file_bytes)
-        else:
-            image = Image.open(io.BytesIO(file_bytes))
+        file_obj = get_upload_file(file)
+        
+        # Convert to image (off the event loop)
+        image = await loop.run_in_executor(executor, load_file_image, file_obj, file.content_type)
         
         if image is None:
             raise HTTPException(status_code=400, detail="Failed to process file")
         
-        # Extract all structured fields using Donut
-        structured_data = extract_all_structured_fields(image)
+        # Extract all structured fields using Donut (batched with concurrent requests)
+        structured_data = await submit_structured_extract(image)
         
         return JSONResponse(content=structured_data)
     
+    except HTTPException:
+        raise
+    
     except Exception as e:
         logger.error(f"Error in /ai-structured-extract: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -303,6 +1041,8 @@ async def ai_structured_extract(file: UploadFile = File(...)):
 # STARTUP
 # ============================================================
 
+# Models are loaded and warmed up in lifespan() (see CONFIGURATION)
+
 if __name__ == "__main__":
     import uvicorn
     
@@ -0,0 +1,106 @@
+"""
+PaddleOCR setup shared by the AI service and its OCR worker processes.
+Only imports what OCR needs, so spawned workers do not load torch,
+transformers or FastAPI.
+"""
+
+from paddleocr import PaddleOCR
+import logging
+import os
+import numpy as np
+from typing import List, Optional
+
+logger = logging.getLogger(__name__)
+
+# PaddleOCR can run its det/rec/cls models through ONNX Runtime instead of Paddle Inference.
+# Export them once with paddle2onnx into PADDLE_OCR_ONNX_DIR as det.onnx, rec.onnx, cls.onnx
+PADDLE_OCR_LANG = os.environ.get("PADDLE_OCR_LANG", "en")
+PADDLE_OCR_USE_ANGLE_CLS = os.environ.get("PADDLE_OCR_USE_ANGLE_CLS", "True").lower() == "true"
+PADDLE_OCR_USE_ONNX = os.environ.get("PADDLE_OCR_USE_ONNX", "False").lower() == "true"
+PADDLE_OCR_ONNX_DIR = os.environ.get("PADDLE_OCR_ONNX_DIR", "models/paddleocr-onnx")
+USE_GPU = os.environ.get("USE_GPU", "True").lower() == "true"
+
+# PaddleOCR of a worker process, created by init_ocr_worker()
+worker_ocr: Optional[PaddleOCR] = None
+
+
+def use_onnx_runtime_providers():
+    """
+    Make PaddleOCR build its ONNX sessions with explicit execution providers.
+    paddleocr 2.7 calls ort.InferenceSession(model_path) without providers,
+    which onnxruntime-gpu rejects, and ignores use_gpu on the ONNX path.
+    """
+    import onnxruntime as ort
+    import tools.infer.utility as paddle_infer_utility  # on sys.path once paddleocr is imported
+    
+    providers = ort.get_available_providers()
+    if not USE_GPU:
+        providers = [provider for provider in providers if provider not in ("TensorrtExecutionProvider", "CUDAExecutionProvider")]
+    logger.info(f"PaddleOCR using ONNX Runtime ({', '.join(providers)})")
+    
+    create_predictor = paddle_infer_utility.create_predictor
+    
+    def create_onnx_predictor(args, mode, logger):
+        model_dirs = {"det": args.det_model_dir, "rec": args.rec_model_dir, "cls": args.cls_model_dir}
+        if not args.use_onnx or mode not in model_dirs:
+            return create_predictor(args, mode, logger)
+        
+        session = ort.InferenceSession(model_dirs[mode], providers=providers)
+        return session, session.get_inputs()[0], None, None
+    
+    paddle_infer_utility.create_predictor = create_onnx_predictor
+
+
+def create_paddle_ocr() -> PaddleOCR:
+    """
+    Create the PaddleOCR engine (Paddle Inference, or ONNX Runtime if PADDLE_OCR_USE_ONNX).
+    English by default; the angle classifier is loaded but only used when a
+    request opts in with ?rotate=true
+    """
+    if not PADDLE_OCR_USE_ONNX:
+        return PaddleOCR(use_angle_cls=PADDLE_OCR_USE_ANGLE_CLS, lang=PADDLE_OCR_LANG, show_log=False)
+    
+    use_onnx_runtime_providers()
+    
+    return PaddleOCR(
+        use_angle_cls=PADDLE_OCR_USE_ANGLE_CLS,
+        lang=PADDLE_OCR_LANG,
+        show_log=False,
+        use_onnx=True,
+        det_model_dir=os.path.join(PADDLE_OCR_ONNX_DIR, "det.onnx"),
+        rec_model_dir=os.path.join(PADDLE_OCR_ONNX_DIR, "rec.onnx"),
+        cls_model_dir=os.path.join(PADDLE_OCR_ONNX_DIR, "cls.onnx"),
+    )
+
+
+def run_paddle_ocr(ocr: PaddleOCR, img_array: np.ndarray, rotate: bool) -> List:
+    """OCR one BGR page array; returns PaddleOCR lines: [box, (text, confidence)]"""
+    result = ocr.ocr(img_array, cls=rotate)
+    return result[0] if result and result[0] else []
+
+
+def warmup_paddle_ocr(ocr: PaddleOCR):
+    """Run PaddleOCR once on a blank image so its predictors are initialized"""
+    ocr.ocr(np.zeros((640, 640, 3), dtype=np.uint8), cls=True)
+
+
+def init_ocr_worker():
+    """Process-pool initializer: create and warm up the worker's own PaddleOCR"""
+    global worker_ocr
+    
+    worker_ocr = create_paddle_ocr()
+    warmup_paddle_ocr(worker_ocr)
+
+
+def wait_for_workers(barrier, timeout: float) -> int:
+    """
+    Process-pool warm-up task: block until one such task runs on every worker
+    (barrier is a multiprocessing Manager barrier). Returns the worker's pid.
+    """
+    barrier.wait(timeout)
+    return os.getpid()
+
+
+def ocr_page_worker(img_array: np.ndarray, rotate: bool) -> List:
+    """Process-pool entry point: OCR one page with the worker's PaddleOCR"""
+    return run_paddle_ocr(worker_ocr, img_array, rotate)
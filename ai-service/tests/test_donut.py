@@ -0,0 +1,198 @@
+"""
+Donut prompt grouping, answer mapping and request batching, with stubbed
+tokenizer/model (no weights are loaded).
+"""
+
+from contextlib import nullcontext
+from types import SimpleNamespace
+import asyncio
+
+import pytest
+import torch
+
+import app
+
+
+class FakeTokenizer:
+    """Whitespace tokenizer: one id per word, so prompt length = word count"""
+    
+    pad_token_id = 1
+    eos_token_id = 2
+    unk_token_id = 3
+    
+    def __init__(self):
+        self.vocab = {"<pad>": 1, "</s>": 2, "<unk>": 3}
+    
+    def token_id(self, word):
+        return self.vocab.setdefault(word, len(self.vocab) + 1)
+    
+    def __call__(self, texts, add_special_tokens=False):
+        return SimpleNamespace(input_ids=[[self.token_id(word) for word in text.split()] for text in texts])
+    
+    def decode(self, ids):
+        words = {token_id: word for word, token_id in self.vocab.items()}
+        return " ".join(words[int(token_id)] for token_id in ids)
+
+
+class FakeModel:
+    """
+    Answers "img<image>/<last prompt word>" for each row, followed by
+    extra_words filler tokens and eos, and records every generate() call.
+    """
+    
+    def __init__(self, tokenizer, extra_words=0):
+        self.tokenizer = tokenizer
+        self.extra_words = extra_words
+        self.calls = []
+    
+    def generate(self, encoder_outputs, decoder_input_ids, pad_token_id, eos_token_id, max_new_tokens, **kwargs):
+        self.calls.append({"prompt_ids": decoder_input_ids.tolist(), "max_new_tokens": max_new_tokens})
+        
+        rows = []
+        for image_state, prompt_ids in zip(encoder_outputs.last_hidden_state, decoder_input_ids.tolist()):
+            last_word = self.tokenizer.decode(prompt_ids[-1:])
+            answer = f"img{int(image_state.flatten()[0])}/{last_word}"
+            answer_ids = [self.tokenizer.token_id(answer)] + [self.tokenizer.token_id("more")] * self.extra_words
+            rows.append(prompt_ids + (answer_ids + [eos_token_id])[:max_new_tokens])
+        
+        width = max(len(row) for row in rows)
+        return SimpleNamespace(sequences=torch.tensor([row + [pad_token_id] * (width - len(row)) for row in rows]))
+
+
+@pytest.fixture
+def donut(monkeypatch):
+    """Stub out model loading, devices and cross-attention so decode_prompts runs on fakes"""
+    tokenizer = FakeTokenizer()
+    model = FakeModel(tokenizer)
+    
+    monkeypatch.setattr(app, "load_donut_model", lambda: (SimpleNamespace(tokenizer=tokenizer), model))
+    monkeypatch.setattr(app, "get_donut_device", lambda: "cpu")
+    monkeypatch.setattr(app, "donut_autocast", nullcontext)
+    monkeypatch.setattr(app, "project_cross_attention", lambda model, hidden_state: None)
+    monkeypatch.setattr(app, "build_cross_attention_cache", lambda model, states, image_index: None)
+    return model
+
+
+def encoded(image_count):
+    """Encoder output with one row per image, every value equal to the image index"""
+    hidden_state = torch.arange(image_count, dtype=torch.float32).view(image_count, 1, 1).expand(image_count, 4, 2)
+    return app.BaseModelOutput(last_hidden_state=hidden_state)
+
+
+def test_decode_prompts_groups_by_prompt_length(donut):
+    prompts = ["Short?", "A bit longer?", "Also short?", "Another longer one?"]
+    
+    answers = app.decode_prompts(encoded(1), prompts)
+    
+    assert answers == [f"img0/{prompt.split()[-1]}" for prompt in prompts]
+    # Prompts are 1, 3, 2 and 3 words long: one generate() call per length, never padded
+    assert sorted(len(call["prompt_ids"]) for call in donut.calls) == [1, 1, 2]
+    assert sorted(len(call["prompt_ids"][0]) for call in donut.calls) == [1, 2, 3]
+    assert all(len({len(row) for row in call["prompt_ids"]}) == 1 for call in donut.calls)
+
+
+def test_decode_prompts_maps_answers_back_per_image(donut):
+    prompts = ["Short?", "A bit longer?"] * 3
+    
+    answers = app.decode_prompts(encoded(3), prompts)
+    
+    assert answers == [
+        "img0/Short?", "img0/longer?",
+        "img1/Short?", "img1/longer?",
+        "img2/Short?", "img2/longer?",
+    ]
+
+
+def test_decode_prompts_group_runs_to_its_longest_cap(donut):
+    app.decode_prompts(encoded(1), ["One?", "Two?"], max_new_tokens=[4, 9])
+    
+    assert [call["max_new_tokens"] for call in donut.calls] == [9]
+
+
+def test_decode_prompts_truncated_answers(donut):
+    donut.extra_words = 5
+    prompts = ["Name?", "Total?"]
+    
+    answers = app.decode_prompts(encoded(1), prompts, max_new_tokens=[3, 3], discard_truncated=[False, True])
+    
+    # No eos within 3 tokens: the first answer is cut to its cap, the second is dropped
+    assert answers == ["img0/Name? more more", ""]
+
+
+def test_decode_prompts_keeps_answers_within_cap(donut):
+    donut.extra_words = 1
+    
+    answers = app.decode_prompts(encoded(1), ["Total?"], max_new_tokens=[3], discard_truncated=[True])
+    
+    assert answers == ["img0/Total? more"]
+
+
+def test_extract_structured_fields_batch_returns_empty_fields_on_failure(monkeypatch):
+    def fail(images):
+        raise RuntimeError("encoder failed")
+    
+    monkeypatch.setattr(app, "encode_images", fail)
+    
+    results = app.extract_structured_fields_batch(["a", "b"])
+    
+    assert results == [{field: "" for field in app.DONUT_PROMPTS}] * 2
+
+
+def run_with_batcher(monkeypatch, scenario):
+    """Run scenario() on an event loop with the Donut batcher started"""
+    async def main():
+        monkeypatch.setattr(app, "donut_queue", asyncio.Queue())
+        batcher_task = asyncio.create_task(app.donut_batcher())
+        try:
+            return await scenario()
+        finally:
+            batcher_task.cancel()
+    
+    return asyncio.run(main())
+
+
+def test_batcher_fans_results_out_per_request(monkeypatch):
+    batches = []
+    
+    def extract(images):
+        batches.append(list(images))
+        return [{"image": image} for image in images]
+    
+    monkeypatch.setattr(app, "extract_structured_fields_batch", extract)
+    monkeypatch.setattr(app, "DONUT_MAX_BATCH_SIZE", 2)
+    monkeypatch.setattr(app, "DONUT_BATCH_TIMEOUT_MS", 200)
+    
+    async def scenario():
+        return await asyncio.gather(*(app.submit_structured_extract(image) for image in "abc"))
+    
+    results = run_with_batcher(monkeypatch, scenario)
+    
+    assert results == [{"image": "a"}, {"image": "b"}, {"image": "c"}]
+    assert batches == [["a", "b"], ["c"]]
+
+
+def test_batcher_fails_the_whole_batch_and_keeps_running(monkeypatch):
+    calls = []
+    
+    def extract(images):
+        calls.append(list(images))
+        if len(calls) == 1:
+            raise RuntimeError("batch failed")
+        return [{"image": image} for image in images]
+    
+    monkeypatch.setattr(app, "extract_structured_fields_batch", extract)
+    monkeypatch.setattr(app, "DONUT_MAX_BATCH_SIZE", 2)
+    monkeypatch.setattr(app, "DONUT_BATCH_TIMEOUT_MS", 200)
+    
+    async def scenario():
+        failed = await asyncio.gather(
+            *(app.submit_structured_extract(image) for image in "ab"),
+            return_exceptions=True
+        )
+        after = await app.submit_structured_extract("c")
+        return failed, after
+    
+    failed, after = run_with_batcher(monkeypatch, scenario)
+    
+    assert [str(error) for error in failed] == ["batch failed", "batch failed"]
+    assert after == {"image": "c"}
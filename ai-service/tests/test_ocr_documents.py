@@ -0,0 +1,98 @@
+"""
+Multi-document OCR: page fan-out over the pool and regrouping per document,
+with stubbed OCR (pages are strings, each OCR'd to one line of the same text).
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import pytest
+
+import app
+import ocr_worker
+
+
+def ocr_line(page):
+    """PaddleOCR line for a fake page: [box, (text, confidence)]"""
+    return [[[0, 0], [1, 0], [1, 1], [0, 1]], (page, 0.5)]
+
+
+def document(*pages):
+    """Fake loaded document (see app.load_document) with the given page contents"""
+    return {"pages": list(pages), "page_count": len(pages)}
+
+
+@pytest.fixture
+def ocr(monkeypatch):
+    """Stub page rendering and both OCR paths; records which path ran"""
+    calls = {"in_process": 0, "pool": 0, "reset": 0}
+    
+    def ocr_page_in_process(page, rotate):
+        calls["in_process"] += 1
+        return [ocr_line(page)]
+    
+    def ocr_pages_in_pool(pool, pages, rotate):
+        calls["pool"] += 1
+        return [[ocr_line(page)] for page in pages]
+    
+    def reset_ocr_process_pool(pool):
+        calls["reset"] += 1
+    
+    monkeypatch.setattr(app, "iter_document_pages", lambda document: iter(document["pages"]))
+    monkeypatch.setattr(app, "ocr_page_in_process", ocr_page_in_process)
+    monkeypatch.setattr(app, "ocr_pages_in_pool", ocr_pages_in_pool)
+    monkeypatch.setattr(app, "get_ocr_process_pool", lambda: "pool")
+    monkeypatch.setattr(app, "reset_ocr_process_pool", reset_ocr_process_pool)
+    return calls
+
+
+def test_pages_are_regrouped_per_document_in_order(ocr):
+    documents = [document("a1", "a2"), document("b1"), document("c1", "c2", "c3")]
+    
+    results = app.extract_text_from_documents(documents)
+    
+    assert [result["text"] for result in results] == ["a1\na2", "b1", "c1\nc2\nc3"]
+    assert [result["confidence"] for result in results] == [0.5, 0.5, 0.5]
+    assert ocr["pool"] == 1 and ocr["in_process"] == 0
+
+
+def test_document_without_text_gets_empty_result(ocr, monkeypatch):
+    monkeypatch.setattr(app, "ocr_pages_in_pool", lambda pool, pages, rotate: [[] if page == "blank" else [ocr_line(page)] for page in pages])
+    
+    results = app.extract_text_from_documents([document("a1"), document("blank"), document("c1")])
+    
+    assert results == [
+        {"text": "a1", "confidence": 0.5},
+        {"text": "", "confidence": 0.0},
+        {"text": "c1", "confidence": 0.5},
+    ]
+
+
+def test_single_page_skips_the_pool(ocr):
+    assert app.extract_text_from_document(document("only")) == {"text": "only", "confidence": 0.5}
+    assert ocr["pool"] == 0 and ocr["in_process"] == 1
+
+
+def test_broken_pool_is_reset_and_falls_back_in_process(ocr, monkeypatch):
+    def broken(pool, pages, rotate):
+        next(pages)
+        raise BrokenProcessPool("worker died")
+    
+    monkeypatch.setattr(app, "ocr_pages_in_pool", broken)
+    
+    results = app.extract_text_from_documents([document("a1", "a2"), document("b1")])
+    
+    assert [result["text"] for result in results] == ["a1\na2", "b1"]
+    assert ocr["reset"] == 1 and ocr["in_process"] == 3
+
+
+def test_ocr_pages_in_pool_keeps_page_order(monkeypatch):
+    monkeypatch.setattr(app, "OCR_PROCESS_WORKERS", 2)
+    monkeypatch.setattr(app, "to_paddle_array", lambda page: page)
+    monkeypatch.setattr(ocr_worker, "ocr_page_worker", lambda page, rotate: [ocr_line(page)])
+    pages = [f"p{index}" for index in range(9)]
+    
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        page_lines = app.ocr_pages_in_pool(pool, iter(pages), rotate=False)
+    
+    assert page_lines == [[ocr_line(page)] for page in pages]
@@ -0,0 +1,103 @@
+"""
+Upload limits: the Content-Length middleware, the per-file size check and
+the PDF page cap all answer 413 (models and OCR are stubbed).
+"""
+
+import io
+
+import fitz
+import pytest
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+from starlette.datastructures import UploadFile
+
+import app
+
+# No context manager: lifespan (model warm-up) is not run
+client = TestClient(app.app)
+
+
+@pytest.fixture
+def small_limits(monkeypatch):
+    """10-byte file limit; document loading and OCR are stubbed"""
+    monkeypatch.setattr(app, "MAX_UPLOAD_BYTES", 10)
+    monkeypatch.setattr(app, "load_document", lambda file_obj, content_type: {"page_count": 1})
+    monkeypatch.setattr(app, "extract_text_from_documents", lambda documents, rotate: [
+        {"text": "ok", "confidence": 1.0} for _ in documents
+    ])
+    monkeypatch.setattr(app, "extract_text_from_document", lambda document, rotate: {"text": "ok", "confidence": 1.0})
+
+
+def upload(name, size, field="file"):
+    """Multipart file entry of the given size"""
+    return (field, (name, b"x" * size, "image/png"))
+
+
+def test_oversized_request_is_rejected_from_content_length(small_limits, monkeypatch):
+    monkeypatch.setattr(app, "MULTIPART_OVERHEAD_BYTES", 0)
+    
+    response = client.post("/extract-text", files=[upload("big.png", 100)])
+    
+    assert response.status_code == 413
+    assert "per file" in response.json()["detail"]
+
+
+def test_oversized_file_is_rejected_by_size(small_limits, monkeypatch):
+    # Let the request through the middleware, so the per-file check answers
+    monkeypatch.setattr(app, "MULTIPART_OVERHEAD_BYTES", 10_000)
+    
+    response = client.post("/extract-text", files=[upload("big.png", 100)])
+    
+    assert response.status_code == 413
+    assert response.json()["detail"].startswith("File too large")
+
+
+def test_file_within_limit_is_accepted(small_limits, monkeypatch):
+    monkeypatch.setattr(app, "MULTIPART_OVERHEAD_BYTES", 10_000)
+    
+    response = client.post("/extract-text", files=[upload("small.png", 10)])
+    
+    assert response.status_code == 200
+    assert response.json() == {"text": "ok", "confidence": 1.0}
+
+
+def test_batch_request_allows_one_limit_per_file(small_limits, monkeypatch):
+    monkeypatch.setattr(app, "MAX_UPLOAD_BYTES", 1000)
+    monkeypatch.setattr(app, "MAX_BATCH_FILES", 3)
+    monkeypatch.setattr(app, "MULTIPART_OVERHEAD_BYTES", 1000)
+    files = [upload(f"batch{index}.png", 900, field="files") for index in range(3)]
+    
+    # 2.7 KB of files: over one file's limit, within three
+    assert client.post("/extract-text", files=[upload("big.png", 2700)]).status_code == 413
+    response = client.post("/extract-text-batch", files=files)
+    
+    assert response.status_code == 200
+    assert [result["filename"] for result in response.json()["results"]] == ["batch0.png", "batch1.png", "batch2.png"]
+
+
+def test_get_upload_file_checks_size_and_rewinds(monkeypatch):
+    monkeypatch.setattr(app, "MAX_UPLOAD_BYTES", 10)
+    
+    file_obj = io.BytesIO(b"0123456789")
+    file_obj.read()
+    assert app.get_upload_file(UploadFile(file_obj, size=10)).read() == b"0123456789"
+    
+    with pytest.raises(HTTPException) as error:
+        app.get_upload_file(UploadFile(io.BytesIO(b"x" * 11), size=11))
+    assert error.value.status_code == 413
+
+
+def pdf_with_pages(page_count):
+    with fitz.open() as doc:
+        for _ in range(page_count):
+            doc.new_page()
+        return doc.tobytes()
+
+
+def test_pdf_page_cap(monkeypatch):
+    monkeypatch.setattr(app, "MAX_PDF_PAGES", 2)
+    
+    assert app.load_document(io.BytesIO(pdf_with_pages(2)), "application/pdf")["page_count"] == 2
+    with pytest.raises(HTTPException) as error:
+        app.load_document(io.BytesIO(pdf_with_pages(3)), "application/pdf")
+    assert error.value.status_code == 413